@@ -1,25 +1,46 @@
 import os
 import sys
+import json
+import hashlib
 import typing
 import pathlib
 import argparse
 import time
+import asyncio
+import collections
 import shutil
-from os import listdir
-from os.path import isfile, join
-from typing import Final, Any, List, Dict, Tuple
+import subprocess
+from os.path import join
+from typing import Final, Any, List, Dict, Tuple, Optional, AsyncGenerator, AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import ffmpeg
-import psycopg2
-import requests
+import aiohttp
+import asyncpg
 import numpy as np
 from tqdm import tqdm
-from tqdm.contrib import tzip
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 
 from utils import draw_detection
 
+SCRIPT_DIR: Final = os.path.dirname(os.path.realpath(__file__))
+PIPE_BUFFER_SIZE: Final = 1 << 20
+HASH_CHUNK_SIZE: Final = 1 << 20
+DOWNLOAD_CHUNK_SIZE: Final = 32 * 1024 * 1024
+DOWNLOAD_MAX_WORKERS: Final = 8
+DRAW_WINDOW: Final = 2 * (os.cpu_count() or 1)
+TRIGGER_QUEUE_SIZE: Final = 64
+POLL_MIN_DELAY: Final = 0.05
+POLL_MAX_DELAY: Final = 2.0
+DB_POOL_SIZE: Final = 4
+DB_FETCH_SIZE: Final = 1024
+POLL_TIMEOUT: Final = 30
+TRIGGER_MAX_RETRIES: Final = 3
+TRIGGER_RETRY_DELAY: Final = 0.5
+FETCH_DETECTIONS_QUERY: Final = """SELECT _airbyte_raw_vdp._airbyte_data->>'index' AS "index", _airbyte_raw_vdp._airbyte_data->'detection'->'objects' AS "objects" from _airbyte_raw_vdp WHERE _airbyte_raw_vdp._airbyte_data->>'index' = ANY($1::text[])"""
+
 
 def download_data(bucket_name: str, blob_filename: str, dst_filename: str) -> bool:
     r""" Download a file from a GCS bucket into a local file
@@ -37,82 +58,331 @@ def download_data(bucket_name: str, blob_filename: str, dst_filename: str) -> bo
 
     client = storage.Client.create_anonymous_client()
     bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_filename)
     try:
-        blob.download_to_filename(dst_filename)
+        blob = bucket.get_blob(blob_filename)
+        if blob is None:
+            print("blob {} not found in bucket {}".format(blob_filename, bucket_name))
+            return False
+        if blob.size > DOWNLOAD_CHUNK_SIZE:
+            # fetch byte ranges of the blob over several connections at once
+            transfer_manager.download_chunks_concurrently(
+                blob, dst_filename, chunk_size=DOWNLOAD_CHUNK_SIZE, worker_type=transfer_manager.THREAD, max_workers=DOWNLOAD_MAX_WORKERS)
+        else:
+            blob.download_to_filename(dst_filename)
     except Exception as e:
         print(e)
-        os.remove(dst_filename)
+        if os.path.exists(dst_filename):
+            os.remove(dst_filename)
         return False
     print("Done!")
     return True
 
-def extract_frames_from_video(image_dir: str, filename: str, framerate: int=30) -> bool:
+def _extract_frames_with_ffmpeg(frame_file: str, filename: str, framerate: int, hwaccel: bool) -> bool:
+    input_kwargs = dict(hwaccel='cuda') if hwaccel else {}
+    try:
+        (
+            ffmpeg.input(filename, **input_kwargs)
+                .filter('fps', fps=framerate)
+                .output(frame_file, format='rawvideo', pix_fmt='bgr24')
+                .overwrite_output()
+                .run(capture_stdout=True, capture_stderr=True)
+        )
+        return True
+    except ffmpeg.Error as error:
+        print('stderr:', error.stderr.decode('utf8'))
+        return False
+
+
+def _sample_frames_with_opencv(frame_file: str, filename: str, source_fps: float, framerate: int) -> bool:
+    # grab() demuxes and decodes every frame, retrieve() only converts the decoded frame to BGR, so the frames dropped
+    # by the sampling skip the colour conversion and the copy into a numpy array, but not the decoding
+    cap = cv2.VideoCapture(filename)
+    if not cap.isOpened():
+        print("failed to open video {}".format(filename))
+        return False
+    # rotate the frames by the display matrix, like ffmpeg does
+    cap.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+    try:
+        with open(frame_file, 'wb', buffering=PIPE_BUFFER_SIZE) as f:
+            i, num_sampled = 0, 0
+            # decode every sampled frame into the same buffer; it is written out before the next one is decoded
+            frame = None
+            while cap.grab():
+                # keep the frame nearest to the next sampling timestamp, like the default rounding of the ffmpeg fps filter
+                if i >= int(num_sampled * source_fps / framerate + 0.5):
+                    ok, frame = cap.retrieve(frame)
+                    if not ok:
+                        print("failed to decode frame {} of video {}".format(i, filename))
+                        return False
+                    f.write(frame)
+                    num_sampled += 1
+                i += 1
+    finally:
+        cap.release()
+    return True
+
+
+def extract_frames_from_video(frame_file: str, filename: str, framerate: int=30, hwaccel: bool=False) -> Optional[np.ndarray]:
     r""" Extract frames from a video file at constant frames per second
 
+    The frames are written as raw BGR bytes into a single file, which is then memory-mapped. No intermediate
+    image files are encoded and decoded again, and long videos do not have to fit in memory. When `framerate` is
+    lower than the frame rate of the video, the frames are sampled with OpenCV, unless decoding is offloaded to the GPU.
+    Every frame is still decoded either way; only the sampled frames are converted to BGR.
+
     Args:
-        image_dir (str): the directory where the extracted frames will be stored
+        frame_file (str): the file where the raw frames will be stored
         filename (str): name of the video file
         framerate (int): frames per second (fps) to extract the video. By default set to 30 fps.
+        hwaccel (bool): decode the video on an NVIDIA GPU (NVDEC). By default set to False.
 
-    Returns: bool
-        a flag to indicate whether the extraction is successful
+    Returns: Optional[np.ndarray]
+        a read-only memory map of shape (N, height, width, 3) with the extracted frames in BGR order, or None if the extraction fails
 
     """
-    if os.path.exists(image_dir) and os.path.isdir(image_dir):
-        shutil.rmtree(image_dir)
-
-    print("\n===== Extract frames from the video {} into {} ...".format(filename, image_dir))
+    print("\n===== Extract frames from the video {} into {} ...".format(filename, frame_file))
 
-    pathlib.Path(image_dir).mkdir(parents=True, exist_ok=True)
     try:
-        (
-            ffmpeg.input(filename)
-                .filter('fps', fps=framerate)
-                .output(join(image_dir, 'frame%5d.png'),
-                        start_number=0)
-                .run(capture_stdout=True, capture_stderr=True)
-        )
-        print("Done!\n")
-        return True
+        probe = ffmpeg.probe(filename)
     except ffmpeg.Error as error:
-        print('stdout:', error.stdout.decode('utf8'))
         print('stderr:', error.stderr.decode('utf8'))
-        shutil.rmtree(image_dir)
-        return False
+        return None
+    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+    if video_stream is None:
+        print("no video stream found in {}".format(filename))
+        return None
+    width, height = int(video_stream['width']), int(video_stream['height'])
+    # the frames are rotated by the display matrix while decoding, so a portrait clip comes out as height x width
+    rotation = video_stream.get('tags', {}).get('rotate', 0)
+    for side_data in video_stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if int(float(rotation)) % 180 != 0:
+        width, height = height, width
+    num, den = map(int, video_stream.get('avg_frame_rate', '0/0').split('/'))
+    source_fps = num / den if den else 0
+
+    pathlib.Path(frame_file).parent.mkdir(parents=True, exist_ok=True)
+    if framerate < source_fps and not hwaccel:
+        success = _sample_frames_with_opencv(frame_file, filename, source_fps, framerate)
+    else:
+        success = _extract_frames_with_ffmpeg(frame_file, filename, framerate, hwaccel)
+    if not success:
+        return None
+    size, frame_size = os.path.getsize(frame_file), width * height * 3
+    if size % frame_size != 0:
+        print("extracted {} bytes, not a whole number of {}x{} frames".format(size, width, height))
+        return None
+    num_frames = size // frame_size
+    if num_frames == 0:
+        print("no frame extracted from the video {}".format(filename))
+        return None
+
+    print("Done!\n")
+    return np.memmap(frame_file, dtype=np.uint8, mode='r', shape=(num_frames, height, width, 3))
 
 
-def generate_video_from_frames(image_dir: str, output_filename: str, framerate: int=30) -> bool:
-    r""" Generate a video from a array of image frames
+def frame_cache_dir(filename: str, framerate: int) -> str:
+    r""" Directory where the frames extracted from a video file at `framerate` fps are cached
 
     Args:
-        image_dir (str): the directory where the image frames are stored
+        filename (str): name of the video file
+        framerate (int): frames per second (fps) to extract the video
+
+    Returns: str
+        a directory keyed by the content hash of the video file and the frame rate
+
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    with open(filename, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return join(SCRIPT_DIR, ".cache", "{}_fps{}".format(digest.hexdigest(), framerate))
+
+
+def load_cached_frames(cache_dir: str) -> Optional[np.ndarray]:
+    r""" Load the frames cached in `cache_dir` by `save_frame_cache_index`
+
+    Args:
+        cache_dir (str): the cache directory returned by `frame_cache_dir`
+
+    Returns: Optional[np.ndarray]
+        a read-only memory map of shape (N, height, width, 3) with the cached frames in BGR order, or None if there is
+        no complete cache entry
+
+    """
+    try:
+        with open(join(cache_dir, "index.json")) as f:
+            index = json.load(f)
+        frame_file = join(cache_dir, index["frame_file"])
+        shape = (index["num_frames"], index["height"], index["width"], 3)
+        if os.path.getsize(frame_file) != int(np.prod(shape)):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return np.memmap(frame_file, dtype=np.uint8, mode='r', shape=shape)
+
+
+def save_frame_cache_index(cache_dir: str, frames: np.memmap, framerate: int) -> None:
+    r""" Record the frames extracted into `cache_dir`, so that later runs can load them with `load_cached_frames`
+
+    The index is written last, so an interrupted extraction never leaves a cache entry that looks complete. The entries
+    cached for the same video at other frame rates are then removed, so the cache holds at most one entry per video.
+
+    Args:
+        cache_dir (str): the cache directory returned by `frame_cache_dir`
+        frames (np.memmap): the memory-mapped frames of shape (N, height, width, 3) stored in `cache_dir`
+        framerate (int): frames per second (fps) the frames were extracted at
+
+    """
+    num_frames, height, width, _ = frames.shape
+    index = dict(frame_file=os.path.basename(frames.filename), num_frames=num_frames, height=height, width=width, framerate=framerate)
+    with open(join(cache_dir, "index.json"), 'w') as f:
+        json.dump(index, f)
+
+    parent, name = os.path.split(cache_dir)
+    prefix = name.rsplit("_fps", 1)[0] + "_fps"
+    with os.scandir(parent) as it:
+        stale = [entry.path for entry in it if entry.is_dir() and entry.name.startswith(prefix) and entry.name != name]
+    for path in stale:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def generate_video_from_frames(frames: AsyncGenerator[np.ndarray, None], output_filename: str, width: int, height: int, framerate: int=30, hwaccel: bool=False) -> bool:
+    r""" Generate a video from a stream of image frames
+
+    The frames are piped into the ffmpeg encoder as raw BGR bytes as soon as they are available. If the task is
+    cancelled or fails, the encoder is killed and `frames` is closed.
+
+    Args:
+        frames (AsyncGenerator[np.ndarray, None]): the image frames of shape (height, width, 3) in BGR order
         output_filename (str): the name of the video file to be generated
+        width (int): width of the frames
+        height (int): height of the frames
         framerate (int): fps of the video to be generated
+        hwaccel (bool): encode the video on an NVIDIA GPU (NVENC). By default set to False.
 
     Returns: bool
         a flag to indicate whether the operation is successful
 
     """
-    if os.path.exists(output_filename):
-        os.remove(output_filename)
-
-    print("\n=====Generate video {} from image files in {}...".format(output_filename, image_dir))
+    output_kwargs = dict(vcodec='h264_nvenc') if hwaccel else {}
+    args = (
+        ffmpeg
+            .input('pipe:', format='rawvideo', pix_fmt='bgr24', s='{}x{}'.format(width, height), framerate=framerate)
+            .output(output_filename, pix_fmt="yuv420p", **output_kwargs)
+            .overwrite_output()
+            .global_args('-loglevel', 'error')
+            .compile()
+    )
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
     try:
-        (
-            ffmpeg
-                .input(join(image_dir, '*.png'), pattern_type='glob', framerate=framerate)
-                .output(output_filename, pix_fmt="yuv420p")
-                .run()
-        )
-        print("Done!\n")
-        return True
-    except ffmpeg.Error as error:
-        print(error)
+        try:
+            async for frame in frames:
+                await asyncio.to_thread(proc.stdin.write, frame)
+        except BrokenPipeError:
+            # ffmpeg exited early, its exit code is reported below
+            pass
+        finally:
+            await frames.aclose()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        await asyncio.to_thread(proc.wait)
+    except BaseException:
+        # do not leave a running encoder behind an aborted run
+        proc.kill()
+        await asyncio.to_thread(proc.wait)
+        raise
+    if proc.returncode != 0:
+        print("ffmpeg exited with code {}".format(proc.returncode))
         return False
+    return True
+
+
+def progress_bar(total: int, desc: str) -> tqdm:
+    r""" Progress bar redrawn at most twice a second and every ~0.5% of `total`, so updates stay cheap per frame """
+    return tqdm(total=total, desc=desc, mininterval=0.5, miniters=max(1, total // 200))
 
 
-def parse_detection_from_database(detection_ls: List[Dict[str, Any]]) -> Tuple[List[Tuple[float]], List[str], List[float]]:
+def frame_filename(index: int) -> str:
+    r""" File name of the frame at `index`, zero-padded so the names sort in frame order """
+    return 'frame{:05d}.png'.format(index)
+
+
+async def trigger_pipeline(api_gateway_url: str, pipeline_id: str, frames: np.ndarray, img_batch: List[List[int]], concurrency: int=32, trigger_queue: Optional[asyncio.Queue]=None) -> List[str]:
+    r""" Trigger an ASYNC pipeline with batches of video frames, keeping many requests in flight at once
+
+    Args:
+        api_gateway_url (str): VDP API base URL
+        pipeline_id (str): VDP pipeline ID
+        frames (np.ndarray): the video frames of shape (N, height, width, 3) in BGR order
+        img_batch (List[List[int]]): a list of batches of frame indices, each batch is sent as a multi-file multipart request
+        concurrency (int): maximum number of requests in flight. By default set to 32.
+        trigger_queue (Optional[asyncio.Queue]): if given, a `(frame index, data mapping index)` pair is put on the queue
+            as soon as each frame is triggered, followed by `None` once all the frames are triggered
+
+    Returns: List[str]
+        the data mapping indices returned by the pipeline, in the same order as the frames in `img_batch`
+
+    """
+    url = f'{api_gateway_url}/v1alpha/pipelines/{pipeline_id}/triggerAsyncMultipart'
+    semaphore = asyncio.Semaphore(concurrency)
+    pbar = progress_bar(sum(len(batch) for batch in img_batch), desc="trigger")
+
+    async def trigger_one(session: aiohttp.ClientSession, batch: List[int]) -> List[str]:
+        async with semaphore:
+            files = []
+            for i in batch:
+                # cv2 releases the GIL while encoding, so run it off the event loop
+                _, buffer = await asyncio.to_thread(cv2.imencode, '.png', frames[i])
+                files.append((frame_filename(i), buffer.tobytes()))
+            for attempt in range(TRIGGER_MAX_RETRIES + 1):
+                # a FormData can only be sent once, so rebuild it from the encoded bytes on every attempt
+                form = aiohttp.FormData()
+                for filename, content in files:
+                    form.add_field("file", content, filename=filename, content_type="image/png")
+                try:
+                    async with session.post(url, data=form) as resp:
+                        resp.raise_for_status()
+                        indices = (await resp.json())['data_mapping_indices']
+                    break
+                except aiohttp.ClientConnectorError:
+                    # only retry when the connection could not be established: triggering is not idempotent, so a
+                    # request that may have reached the server is never sent twice
+                    if attempt == TRIGGER_MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(TRIGGER_RETRY_DELAY * 2 ** attempt)
+        if len(indices) != len(batch):
+            raise ValueError("number of frames {} not consistent with number of records {}".format(len(batch), len(indices)))
+        if trigger_queue is not None:
+            for i, mapping_index in zip(batch, indices):
+                await trigger_queue.put((i, mapping_index))
+        pbar.update(len(batch))
+        return indices
+
+    # at most one connection per request in flight, kept alive and reused across requests
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = [asyncio.create_task(trigger_one(session, batch)) for batch in img_batch]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # stop the other requests before the session is closed under them
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+    finally:
+        pbar.close()
+    if trigger_queue is not None:
+        await trigger_queue.put(None)
+
+    return [index for indices in results for index in indices]
+
+
+def parse_detection_from_database(detection_ls: List[Dict[str, Any]]) -> Tuple[np.ndarray, List[str], np.ndarray]:
     r""" Parse the raw detection output from the database
 
     Args:
@@ -131,25 +401,213 @@ def parse_detection_from_database(detection_ls: List[Dict[str, Any]]) -> Tuple[L
         ]
 
     Returns: parsed output, a tuple of
-        List[Tuple[float]]: a list of detected bounding boxes in the format of (left, top, width, height)
+        np.ndarray: an int32 array of shape (N, 4) with the detected bounding boxes in the format of (left, top, width, height)
         List[str]: a list of category labels, each of which corresponds to a detected bounding box. The length of this list must be the same as the detected bounding boxes.
-        List[float]: a list of scores, each of which corresponds to a detected bounding box. The length of this list must be the same as the detected bounding boxes.
+        np.ndarray: a float32 array of shape (N,) with the scores, each of which corresponds to a detected bounding box.
 
     """
-    boxes_ltwh, categories, scores = [], [], []
+    n = len(detection_ls)
+    boxes_ltwh = np.empty((n, 4), dtype=np.int32)
+    categories = [None] * n
+    scores = np.empty(n, dtype=np.float32)
 
-    for det in detection_ls:
-        boxes_ltwh.append((
-            det["bounding_box"]["left"],
-            det["bounding_box"]["top"],
-            det["bounding_box"]["width"],
-            det["bounding_box"]["height"]))
-        categories.append(det["category"])
-        scores.append(det["score"])
+    for i, det in enumerate(detection_ls):
+        box = det["bounding_box"]
+        boxes_ltwh[i] = box["left"], box["top"], box["width"], box["height"]
+        categories[i] = det["category"]
+        scores[i] = det["score"]
 
     return boxes_ltwh, categories, scores
 
 
+def _draw_frame(frame: np.ndarray, i: int, row: List[Dict[str, Any]]) -> Optional[np.ndarray]:
+    # Runs in a worker thread; cv2 releases the GIL while drawing, so frames are drawn in parallel without copying
+    # any pixel data between processes
+    try:
+        boxes_ltwh, categories, scores = parse_detection_from_database(row)
+        return draw_detection(frame, boxes_ltwh, categories, scores)
+    except Exception as error:
+        # a malformed detection only costs its own frame
+        print("failed to draw frame {}: {!r}".format(i, error))
+        return None
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # decode jsonb columns into Python objects instead of JSON strings
+    await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def poll_detections(trigger_queue: asyncio.Queue, detections: Dict[int, asyncio.Future], db_params: Dict[str, Any]) -> None:
+    r""" Poll the destination PostgreSQL database for the detections of the triggered frames
+
+    All the frames triggered so far are looked up together in a single query, until each of them has a record. The
+    delay between two queries starts at `POLL_MIN_DELAY` and doubles up to `POLL_MAX_DELAY` while no new record shows up.
+
+    Args:
+        trigger_queue (asyncio.Queue): the queue of `(frame index, data mapping index)` pairs filled by `trigger_pipeline`
+        detections (Dict[int, asyncio.Future]): a future per frame index, resolved with the raw detections of the frame,
+            or with None if no record shows up within `POLL_TIMEOUT` seconds after the frame is triggered
+        db_params (Dict[str, Any]): keyword arguments for `asyncpg.create_pool`
+
+    """
+    pool = await asyncpg.create_pool(**db_params, min_size=1, max_size=DB_POOL_SIZE, init=_init_connection)
+    # data mapping index -> (frame index, deadline)
+    pending: Dict[str, Tuple[int, float]] = {}
+    triggered = False
+    delay = POLL_MIN_DELAY
+
+    def take(item: Optional[Tuple[int, str]]) -> None:
+        nonlocal triggered
+        if item is None:
+            triggered = True
+        else:
+            i, mapping_index = item
+            pending[mapping_index] = (i, time.monotonic() + POLL_TIMEOUT)
+
+    def resolve(mapping_index: str, row: List[Dict[str, Any]]) -> bool:
+        # Airbyte delivers at least once, so the raw table can hold several rows for the same index
+        entry = pending.pop(mapping_index, None)
+        if entry is None:
+            return False
+        i, _ = entry
+        detections[i].set_result(row)
+        return True
+
+    try:
+        while not triggered or pending:
+            if not pending:
+                take(await trigger_queue.get())
+            while not triggered and not trigger_queue.empty():
+                take(trigger_queue.get_nowait())
+            if not pending:
+                continue
+
+            num_found = 0
+            try:
+                if len(pending) > DB_FETCH_SIZE:
+                    # stream a large result set through a server-side cursor, so the frames can be drawn while the rest
+                    # of the rows are still being fetched
+                    async with pool.acquire() as conn, conn.transaction():
+                        async for mapping_index, row in conn.cursor(FETCH_DETECTIONS_QUERY, list(pending), prefetch=DB_FETCH_SIZE):
+                            num_found += resolve(mapping_index, row)
+                else:
+                    for mapping_index, row in await pool.fetch(FETCH_DETECTIONS_QUERY, list(pending)):
+                        num_found += resolve(mapping_index, row)
+            except asyncpg.UndefinedTableError:
+                # on a fresh destination Airbyte creates the raw table with its first sync, so no record is there yet
+                pass
+            now = time.monotonic()
+            for mapping_index, (i, deadline) in list(pending.items()):
+                if now > deadline:
+                    print("no record found for data mapping index {} after {} seconds".format(mapping_index, POLL_TIMEOUT))
+                    detections[i].set_result(None)
+                    del pending[mapping_index]
+
+            # poll again soon while records keep showing up, back off exponentially while they do not
+            delay = POLL_MIN_DELAY if num_found else min(2 * delay, POLL_MAX_DELAY)
+            if pending:
+                await asyncio.sleep(delay)
+    finally:
+        await pool.close()
+
+
+async def draw_detections_on_frames(frames: np.memmap, frame_indices: List[int], detections: Dict[int, asyncio.Future], executor: ThreadPoolExecutor) -> AsyncIterator[np.ndarray]:
+    r""" Draw the detections on the video frames
+
+    The frames are drawn in parallel by `executor` as soon as their detections are available, and
+    yielded in frame order.
+
+    Args:
+        frames (np.memmap): the memory-mapped video frames of shape (N, height, width, 3) in BGR order
+        frame_indices (List[int]): the indices of the frames that were sent to the pipeline
+        detections (Dict[int, asyncio.Future]): a future per frame index, resolved with the raw detections of the frame
+        executor (ThreadPoolExecutor): the pool of worker threads drawing the frames
+
+    Returns: AsyncIterator[np.ndarray]
+        the frames overlaid with detection results. Frames without detections, or whose detections cannot be drawn,
+        are skipped.
+
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = collections.deque()
+    with progress_bar(len(frame_indices), desc="draw") as pbar:
+        try:
+            for i in frame_indices:
+                row = await detections[i]
+                # drop the resolved future, so the detections of a frame are released once it is drawn
+                del detections[i]
+                if row is not None:
+                    in_flight.append(loop.run_in_executor(executor, _draw_frame, frames[i], i, row))
+                else:
+                    pbar.update(1)
+                if len(in_flight) >= DRAW_WINDOW:
+                    img_draw = await in_flight.popleft()
+                    pbar.update(1)
+                    if img_draw is not None:
+                        yield img_draw
+            while in_flight:
+                img_draw = await in_flight.popleft()
+                pbar.update(1)
+                if img_draw is not None:
+                    yield img_draw
+        finally:
+            # the consumer stopped early, so the frames not started yet are never drawn
+            for future in in_flight:
+                future.cancel()
+
+
+async def process_video(api_gateway_url: str, pipeline_id: str, frames: np.memmap, img_batch: List[List[int]], concurrency: int,
+                        db_params: Optional[Dict[str, Any]], output_filename: str, framerate: int, hwaccel: bool=False) -> bool:
+    r""" Trigger the pipeline with the video frames and generate a video with the detections drawn on the frames
+
+    The work runs as a pipeline of concurrent stages, so the frames are triggered, polled for in the database, drawn
+    and encoded at the same time:
+
+        trigger_pipeline -> trigger_queue -> poll_detections -> detections -> draw_detections_on_frames -> generate_video_from_frames
+
+    Args:
+        api_gateway_url (str): VDP API base URL
+        pipeline_id (str): VDP pipeline ID
+        frames (np.memmap): the memory-mapped video frames of shape (N, height, width, 3) in BGR order
+        img_batch (List[List[int]]): a list of batches of frame indices, each batch is sent in one request
+        concurrency (int): maximum number of trigger requests in flight
+        db_params (Optional[Dict[str, Any]]): keyword arguments for `asyncpg.create_pool`, or None to only trigger the pipeline
+        output_filename (str): the name of the video file to be generated
+        framerate (int): fps of the video to be generated
+        hwaccel (bool): encode the video on an NVIDIA GPU (NVENC). By default set to False.
+
+    Returns: bool
+        a flag to indicate whether the operation is successful
+
+    """
+    if db_params is None:
+        await trigger_pipeline(api_gateway_url, pipeline_id, frames, img_batch, concurrency=concurrency)
+        return True
+
+    loop = asyncio.get_running_loop()
+    frame_indices = [i for batch in img_batch for i in batch]
+    detections = {i: loop.create_future() for i in frame_indices}
+    trigger_queue = asyncio.Queue(maxsize=TRIGGER_QUEUE_SIZE)
+    _, height, width, _ = frames.shape
+
+    # the draw workers are threads and are started before any stage runs, so nothing is forked out of the
+    # multi-threaded event loop process
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        tasks = [
+            asyncio.create_task(trigger_pipeline(api_gateway_url, pipeline_id, frames, img_batch, concurrency=concurrency, trigger_queue=trigger_queue)),
+            asyncio.create_task(poll_detections(trigger_queue, detections, db_params)),
+            asyncio.create_task(generate_video_from_frames(
+                draw_detections_on_frames(frames, frame_indices, detections, executor), output_filename, width, height, framerate=framerate, hwaccel=hwaccel)),
+        ]
+        try:
+            _, _, success = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    return success
+
+
 if __name__ ==  '__main__':
     parser = argparse.ArgumentParser(description='Trigger VDP pipeline')
     parser.add_argument('--api-gateway-url', type=str,
@@ -169,16 +627,26 @@ if __name__ ==  '__main__':
                         "Output video file name", default = "output.mp4", type = str)
     parser.add_argument("--framerate", dest = 'framerate', help =
                         "Frame rate of the video", default = 30, type = int)
+    parser.add_argument("--concurrency", dest = 'concurrency', help =
+                        "Maximum number of pipeline trigger requests in flight", default = 32, type = int)
+    parser.add_argument("--batch-size", dest = 'batch_size', help =
+                        "Number of frames sent in each pipeline trigger request", default = 1, type = int)
+    parser.add_argument("--hwaccel", dest="hwaccel", action="store_true", help =
+                        "Decode and encode the video on an NVIDIA GPU (NVDEC/NVENC)")
     parser.add_argument("--skip-draw", dest="draw", action="store_false", help =
                         "Skip draw detections on images")
 
     opt = parser.parse_args()
+    if opt.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if opt.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
 
     ###############################################################################
     # Download video
     ###############################################################################
 
-    video_filename = join(os.path.dirname(os.path.realpath(__file__)), "cows_dornick.mp4")
+    video_filename = join(SCRIPT_DIR, "cows_dornick.mp4")
 
     skip_download = os.path.exists(video_filename)
     if skip_download:
@@ -194,76 +662,34 @@ if __name__ ==  '__main__':
     # Extract frames from the video file
     ###############################################################################
 
-    image_dir = join(os.path.dirname(os.path.realpath(__file__)), "inputs")
-
-    skip_extract = False
-    if os.path.exists(image_dir) and os.path.isdir(image_dir):
-        if os.listdir(image_dir):
-            skip_extract = True
-    if skip_extract:
-        print("\n===== Skip extracting frames from video {}".format(video_filename))
+    cache_dir = frame_cache_dir(video_filename, opt.framerate)
+    frames = load_cached_frames(cache_dir)
+    if frames is not None:
+        print("\n===== Skip extracting frames from video {}, using the frames cached in {}".format(video_filename, cache_dir))
     else:
-        success = extract_frames_from_video(image_dir, video_filename, framerate=opt.framerate)
-        if not success:
+        frames = extract_frames_from_video(join(cache_dir, "frames.bgr"), video_filename, framerate=opt.framerate, hwaccel=opt.hwaccel)
+        if frames is None:
             sys.exit(1)
-
+        save_frame_cache_index(cache_dir, frames, opt.framerate)
 
     ###############################################################################
-    # Trigger pipeline to process video frames
+    # Trigger pipeline to process video frames and draw detections on them
     ###############################################################################
 
-    batch_size = 1
-    img_files = [filename for filename in sorted(listdir(image_dir)) if isfile(
-        join(image_dir, filename)) and not filename.startswith(".")]
-    img_batch = [img_files[i:i+batch_size]  for i in range(0, len(img_files), batch_size)]
-    filenames = [file for files in img_batch for file in files]
-    data_mapping_indices = []
-
-    print("\n=====Trigger {} pipeline to process images in '{}'\n".format(opt.pipeline_id, image_dir))
-    for files in tqdm(img_batch):
-        resp = requests.post(f'{opt.api_gateway_url}/v1alpha/pipelines/{opt.pipeline_id}/triggerAsyncMultipart',
-                        files=[("file", (filename, open(join(image_dir, filename), 'rb'))) for filename in files])
-        if resp.status_code == 200:
-            data_mapping_indices += resp.json()['data_mapping_indices']
-        else:
-            sys.exit(1)
-
-    # ###############################################################################
-    # # Draw detections on video frames
-    # ###############################################################################
+    batch_size = opt.batch_size
+    img_batch = [list(range(i, min(i+batch_size, len(frames)))) for i in range(0, len(frames), batch_size)]
 
     if opt.draw:
-        time.sleep(10)
-        conn = None
-        print("#", end="", flush=True)
-        assert len(filenames) == len(data_mapping_indices), "number of files {} not consistent with number of records {}".format(len(filenames), len(data_mapping_indices))
-
-        # Create output directory
-        output_dir = join(os.path.dirname(os.path.realpath(__file__)), "outputs")
-        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+        db_params = dict(user=opt.pq_username, password=opt.pq_password, host=opt.pq_host, port=opt.pq_port, database=opt.pq_database)
+    else:
+        db_params = None
 
-        for filename, mapping_index in tzip(filenames, data_mapping_indices):
-            # Fetch detections from destination PostgreSQL database
-            try:
-                conn = psycopg2.connect(
-                    user=opt.pq_username, password=opt.pq_password, host=opt.pq_host, port=opt.pq_port, database=opt.pq_database)
-                cur = conn.cursor()
-                cur.execute("""SELECT _airbyte_raw_vdp._airbyte_data->'detection'->'objects' AS "objects" from _airbyte_raw_vdp WHERE _airbyte_raw_vdp._airbyte_data->>'index' = '{}'""".format(mapping_index))
-                row = cur.fetchone()[0]
-
-                boxes_ltwh, categories, scores = parse_detection_from_database(row)
-                buffer = open(join(image_dir, filename), 'rb')
-                arr = np.asarray(bytearray(buffer.read()), dtype=np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                img_draw = draw_detection(img, boxes_ltwh, categories, scores)
-                cv2.imwrite(join(os.path.dirname(os.path.realpath(__file__)), output_dir, filename), img_draw)
-                cur.close()
-
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(error)
-
-        if conn is not None:
-            conn.close()
-
-        # Generate video with detections
-        success = generate_video_from_frames(output_dir, opt.output_filename, framerate=opt.framerate)
+    print("\n=====Trigger {} pipeline to process {} frames of '{}'\n".format(opt.pipeline_id, len(frames), video_filename))
+    try:
+        success = asyncio.run(process_video(
+            opt.api_gateway_url, opt.pipeline_id, frames, img_batch, opt.concurrency, db_params, opt.output_filename, opt.framerate, opt.hwaccel))
+    except (aiohttp.ClientError, asyncpg.PostgresError, OSError, ValueError) as error:
+        print(error)
+        sys.exit(1)
+    if not success:
+        sys.exit(1)
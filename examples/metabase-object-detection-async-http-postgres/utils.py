@@ -1,6 +1,8 @@
 
 import random
+import functools
 import cv2
+import numpy as np
 from enum import Enum
 from typing import List, Tuple
 
@@ -92,10 +94,16 @@ random.seed(1)
 COLORS = [[random.randint(0, 255) for _ in range(3)] for _ in COCOLabels]
 
 
+@functools.lru_cache(maxsize=None)
 def get_label_color(label: str) -> List[int]:
     category_idx = COCOLabels[label.upper()].value - 1
     return COLORS[category_idx]
 
+@functools.lru_cache(maxsize=1024)
+def _get_text_size(text: str, font_scale: float, thickness: int) -> Tuple[int, int]:
+    return cv2.getTextSize(text, 0, fontScale=font_scale, thickness=thickness)[0]
+
+
 def draw_detection(img: cv2.Mat, boxes_ltwh: List[Tuple[float]], categories: List[str], scores: List[float], line_thickness=3) -> cv2.Mat:
     r""" Draw detection results on an image
 
@@ -111,23 +119,22 @@ def draw_detection(img: cv2.Mat, boxes_ltwh: List[Tuple[float]], categories: Lis
 
     tl = line_thickness
     tf = max(tl-1, 1)
-    for box, label, score in zip(boxes_ltwh, categories, scores):
-        left, top, width, height = box
-        x1, y1, x2, y2 = left, top, left + width, top + height
-        c1, c2 = (int(x1), int(y1)), (int(x2), int(y2))
-        color = get_label_color(label)
+    # compute the corners of all the boxes at once, as plain Python ints for the cv2 calls
+    boxes = np.asarray(boxes_ltwh, dtype=np.float64).reshape(-1, 4)
+    corners = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1).astype(np.int64).tolist()
+    texts = [f"{label} {score:.2f}" for label, score in zip(categories, scores)]
 
-        text = f"{label} {score:.2f}"
+    for (x1, y1, x2, y2), label, text in zip(corners, categories, texts):
+        c1, c2 = (x1, y1), (x2, y2)
+        color = get_label_color(label)
 
-        img_draw = cv2.rectangle(
-            img_draw, c1, c2, color, thickness=tl, lineType=cv2.LINE_AA)
+        cv2.rectangle(img_draw, c1, c2, color, thickness=tl, lineType=cv2.LINE_AA)
 
-        t_size = cv2.getTextSize(
-            text, 0, fontScale=tl / 3, thickness=tf)[0]
+        # the same labels and scores come up over and over across frames
+        t_size = _get_text_size(text, tl / 3, tf)
         c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
-        img_draw = cv2.rectangle(
-            img_draw, c1, c2, color, -1, cv2.LINE_AA)  # filled
-        img_draw = cv2.putText(
+        cv2.rectangle(img_draw, c1, c2, color, -1, cv2.LINE_AA)  # filled
+        cv2.putText(
             img_draw, text, (c1[0], c1[1] - 2), 0, tl / 3,
             [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
 
@@ -5,14 +5,14 @@ import argparse
 import cv2
 import ffmpeg
 import psycopg2
-import numpy as np
-from os import listdir
-from os.path import isfile, join
+from os.path import join
 from typing import Final, Any, List, Dict, Tuple
 from tqdm.contrib import tzip
 
 from utils import draw_detection
 
+SCRIPT_DIR: Final = os.path.dirname(os.path.realpath(__file__))
+
 
 ############################################################################
 # Helper Functions
@@ -108,12 +108,13 @@ if __name__ ==  '__main__':
     #########################################################################
 
     print("\n===== Start extracting results from postgres-db")
-    image_dir = join(os.path.dirname(os.path.realpath(__file__)), "inputs")
-    filenames = [filename for filename in sorted(listdir(image_dir)) if isfile(
-        join(image_dir, filename)) and not filename.startswith(".")]
+    image_dir = join(SCRIPT_DIR, "inputs")
+    with os.scandir(image_dir) as it:
+        filenames = sorted(entry.name for entry in it
+            if entry.is_file() and not entry.name.startswith("."))
 
     ## write path
-    output_file = join(os.path.dirname(os.path.realpath(__file__)), "data-mapping-indices.txt")
+    output_file = join(SCRIPT_DIR, "data-mapping-indices.txt")
 
     with open(output_file, "r") as f:
         data_mapping_indices = f.readlines()
@@ -125,7 +126,7 @@ if __name__ ==  '__main__':
         assert len(filenames) == len(data_mapping_indices), "number of files {} not consistent with number of records {}".format(len(filenames), len(data_mapping_indices))
 
         # Create output directory
-        output_dir = join(os.path.dirname(os.path.realpath(__file__)), "outputs")
+        output_dir = join(SCRIPT_DIR, "outputs")
         pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
         result_fetch_success = True
         for filename, mapping_index in tzip(filenames, data_mapping_indices):
@@ -138,11 +139,9 @@ if __name__ ==  '__main__':
                 row = cur.fetchone()[0]
 
                 boxes_ltwh, categories, scores = parse_detection_from_database(row)
-                buffer = open(join(image_dir, filename), 'rb')
-                arr = np.asarray(bytearray(buffer.read()), dtype=np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+                img = cv2.imread(join(image_dir, filename), cv2.IMREAD_COLOR)
                 img_draw = draw_detection(img, boxes_ltwh, categories, scores)
-                cv2.imwrite(join(os.path.dirname(os.path.realpath(__file__)), output_dir, filename), img_draw)
+                cv2.imwrite(join(output_dir, filename), img_draw)
                 cur.close()
 
             except (Exception, psycopg2.DatabaseError) as error:
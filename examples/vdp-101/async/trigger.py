@@ -3,14 +3,17 @@ import sys
 import pathlib
 import argparse
 import shutil
-from os import listdir, path
-from os.path import isfile, join
+from os import path
+from os.path import join
+from typing import Final
 
 import ffmpeg
 import requests
 from tqdm import tqdm
 from google.cloud import storage
 
+SCRIPT_DIR: Final = os.path.dirname(os.path.realpath(__file__))
+
 
 ############################################################################
 # Helper Functions
@@ -122,7 +125,7 @@ if __name__ ==  '__main__':
     # Download video
     ########################################################################
 
-    video_filename = join(os.path.dirname(os.path.realpath(__file__)), "cows_dornick.mp4")
+    video_filename = join(SCRIPT_DIR, "cows_dornick.mp4")
 
     skip_download = os.path.exists(video_filename)
     if skip_download:
@@ -139,7 +142,7 @@ if __name__ ==  '__main__':
     # Extract frames from the video file
     ########################################################################
 
-    image_dir = join(os.path.dirname(os.path.realpath(__file__)), "inputs")
+    image_dir = join(SCRIPT_DIR, "inputs")
 
     skip_extract = False
     if os.path.exists(image_dir) and os.path.isdir(image_dir):
@@ -160,13 +163,14 @@ if __name__ ==  '__main__':
 
     ## prepare image list.
     batch_size = 2
-    img_files = [filename for filename in sorted(listdir(image_dir)) if isfile(
-        join(image_dir, filename)) and not filename.startswith(".")]
+    with os.scandir(image_dir) as it:
+        img_files = sorted(entry.name for entry in it
+            if entry.is_file() and not entry.name.startswith("."))
     img_batch = [img_files[i:i+batch_size]  for i in range(0, len(img_files), batch_size)]
     filenames = [file for files in img_batch for file in files]
 
     ## set write path
-    output_file = join(os.path.dirname(os.path.realpath(__file__)), opt.mapping_file)
+    output_file = join(SCRIPT_DIR, opt.mapping_file)
 
     ## clear previous index record stored in the file.
     with open(output_file, "w") as f: